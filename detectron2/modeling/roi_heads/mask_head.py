@@ -6,15 +6,15 @@ from torch import nn
 from torch.nn import functional as F
 
 from detectron2.layers import Conv2d, ConvTranspose2d, ShapeSpec, cat, get_norm
-from detectron2.structures import Instances
+from detectron2.structures import Boxes, Instances, pairwise_iou
 from detectron2.utils.events import get_event_storage
 from detectron2.utils.registry import Registry
 from detectron2.structures.masks import PolygonMasks
 from itertools import combinations
 
 import numpy as np
-import cv2 as cv
 import pickle, os
+import threading
 import skimage.io as skio
 from shutil import copyfile
 from zipfile import ZipFile 
@@ -105,27 +105,36 @@ class BaseMaskRCNNHead(nn.Module):
         mask_side_len = pred_mask_logits.size(2)
         assert pred_mask_logits.size(2) == pred_mask_logits.size(3), "Mask prediction must be square!"
 
+        # bail out before any penalty bookkeeping when there is nothing to supervise
+        if all(len(instances_per_image) == 0 for instances_per_image in instances):
+            return pred_mask_logits.sum() * 0
+
         gt_classes = []
         gt_masks = []
 
         # -------------------------------------------------------------------------------------------- #
 
         # containers of the weights per instance
-        boundary_penalty = [] 
         roi_penalty = []
         overlap_penalty = []
-        # save model wts and print info
+        # whether any image actually has overlapping gt masks; if none does, the
+        # overlap penalty degenerates to all ones and can be skipped entirely
+        has_overlap = False
+        # save model wts and log info
         FILENAME = 'FILENAME'
-        file_paths = get_all_file_paths('./output/')
         storage = get_event_storage()
         if storage.iter % 20 == 0:
-            print('Learnable weights: {}'.format(self.log_vars.detach().cpu().numpy()))
+            # piggyback on the async event writers instead of printing from the train step
+            log_vars = self.log_vars.detach().cpu()
+            for i, log_var in enumerate(log_vars):
+                storage.put_scalar("mask_rcnn/log_var{}".format(i), log_var)
         if storage.iter > 0 and storage.iter % 6000 == 0:
-            with ZipFile('{}.zip'.format(FILENAME),'w') as zip: 
-                for file in file_paths: 
-                    zip.write(file) 
-            copyfile('./{}.zip'.format(FILENAME), './drive/My Drive/{}.zip'.format(FILENAME))
-            print('Saving weights...')
+            # only crawl the output tree when a snapshot is actually due, and archive
+            # it off the training thread so the step does not block on disk I/O
+            file_paths = get_all_file_paths('./output/')
+            threading.Thread(
+                target=_archive_and_copy, args=(file_paths, FILENAME), daemon=True
+            ).start()
 
         for instances_per_image in instances:
 
@@ -145,92 +154,77 @@ class BaseMaskRCNNHead(nn.Module):
 
             # ---------------------------------------------------------------------------------------- #
 
-            # get the boundary pixels
-            img_bounds = []
-            for m in gt_masks_per_image.detach().cpu().numpy(): # for each ground truth mask
-                kernel = np.ones((3,3), np.uint8) # small square kernel for dilation and erosion
-                background = np.zeros((mask_side_len, mask_side_len)) # container of the contour
-                cnts, _ = cv.findContours(np.where(m==True,255,0).astype(np.uint8), cv.RETR_EXTERNAL,
-                                                                    cv.CHAIN_APPROX_SIMPLE)
-                cv.drawContours(background, cnts, -1, 1, -1) # draw the contours to the container
-                dilation = cv.dilate(background, kernel).astype(np.uint8) # dilate the contours
-                erosion = cv.erode(background, kernel).astype(np.uint8) # erode the contours
-                bound_pixels = np.bitwise_xor(dilation, erosion) # get the boundary bixels
-                c = sorted(cnts, key=cv.contourArea, reverse=True)[0]
-                M = cv.moments(c)
-                if not M['m00'] == 0:
-                    cx = int(M['m10']/M['m00'])
-                    cy = int(M['m01']/M['m00'])
-                    for y in range(mask_side_len):
-                        for x in range(mask_side_len):
-                            if not bound_pixels[y][x] == 0:
-                                d = np.linalg.norm(np.asarray([x, y]) - np.asarray([cx, cy]))
-                                bound_pixels[y][x] = d if d >= 1 else 1
-            boundary_penalty.append(torch.from_numpy(bound_pixels))
-
             # solve for roi penalty
-            # get the gt bboxes for each prediciton
-            ins_gt_boxes = np.asarray([x.detach().cpu().numpy() for x in instances_per_image.gt_boxes])
-            # get the real bboxes (unique) and the number of times they were predicted
-            gt_boxes, roi_counts = np.unique(ins_gt_boxes, axis=0, return_counts=True)
+            # get the real bboxes (unique) and the number of times they were predicted,
+            # staying on the device the gt boxes already live on
+            gt_boxes, roi_counts = torch.unique(
+                instances_per_image.gt_boxes.tensor, dim=0, return_counts=True
+            )
             # find the ROIs that are the closest to the ground truth labels
+            # compute all gt x proposal IoUs in one call and take the best proposal per gt
+            iou = pairwise_iou(Boxes(gt_boxes), instances_per_image.proposal_boxes)
+            best_boxes = iou.argmax(dim=1)
             # place holder for the roi penalty for each image
-            img_roi_penalty = torch.ones((len(instances_per_image), 1, 1))
-            for i, gt_box in enumerate(gt_boxes):
-                # solve for the current closest iou and the index of the current best bbox
-                best_iou, best_box = 0, 0
-                # loop over the predicted bboxes
-                for j, box in enumerate(instances_per_image.proposal_boxes):
-                    iou = bb_intersection_over_union(gt_box, box.detach().cpu().numpy())
-                    if best_iou < iou:
-                        best_iou = iou # replace current best iou
-                        best_box = j # save the index of the current best bbox
-                # after searching, place the penalty on the index of the closest bbox
-                img_roi_penalty[best_box] = torch.tensor(roi_counts[i].item())
+            img_roi_penalty = torch.ones(
+                (len(instances_per_image), 1, 1), device=pred_mask_logits.device
+            )
+            # place the penalty on the index of the closest bbox for each gt
+            img_roi_penalty[best_boxes] = roi_counts.to(dtype=torch.float32).view(-1, 1, 1)
             # aggregate the roi penalties
             roi_penalty.append(img_roi_penalty)
 
             # get the overlapping pixels
             # placeholder for the volume of gt masks for each gt bbox
+            # move the proposal boxes to the host once: every crop_and_resize call
+            # would otherwise re-download them, and rasterizing against host boxes
+            # keeps the results on the host so they go back up in a single transfer
+            proposal_boxes_cpu = instances_per_image.proposal_boxes.tensor.cpu()
             img_masks = []
-            done = [] # placeholder for unique gt mask
-            for x in instances_per_image.gt_masks: 
-                if list(x[0]) not in done:
-                    done.append(list(x[0]))
-                    # generate the current gt mask for the instance for all predictions
-                    temp_msk = [[x[0]] for i in range(len(instances_per_image))]
-                    img_masks.append(PolygonMasks(temp_msk).crop_and_resize(
-                            instances_per_image.proposal_boxes.tensor, mask_side_len
-                            ).to(dtype=torch.float32, device="cuda"))
+            done = set() # hashes of the gt masks already rasterized
+            for x in instances_per_image.gt_masks:
+                key = np.asarray(x[0], dtype=np.float32).tobytes()
+                if key in done:
+                    continue
+                done.add(key)
+                # rasterize the current gt mask only once, cropped to every proposal
+                temp_msk = [[x[0]] for i in range(len(instances_per_image))]
+                img_masks.append(
+                    PolygonMasks(temp_msk).crop_and_resize(proposal_boxes_cpu, mask_side_len)
+                )
             # there is possibly an overlap if there are more than 1 instance
             if len(img_masks) > 1:
-                per_ins_overlap_masks = np.sum(np.asarray(img_masks), 0)
-                per_ins_overlap_masks *= gt_masks_per_image
-                per_ins_overlap_masks = torch.where(per_ins_overlap_masks == 0, 
-                                                        torch.tensor(1.).to(device="cuda"),
-                                                            per_ins_overlap_masks)
+                has_overlap = True
+                # upload the (U, N, M, M) rasterizations in one transfer and sum
+                # them over the unique gt masks
+                per_ins_overlap_masks = (
+                    torch.stack(img_masks)
+                    .to(dtype=torch.float32, device=pred_mask_logits.device)
+                    .sum(dim=0)
+                )
+                per_ins_overlap_masks *= gt_masks_per_image.to(dtype=torch.float32)
+                per_ins_overlap_masks = torch.where(
+                    per_ins_overlap_masks == 0,
+                    per_ins_overlap_masks.new_ones(()),
+                    per_ins_overlap_masks,
+                )
             else: # no overlap!
-                per_ins_overlap_masks = torch.ones(gt_masks_per_image.shape)
+                per_ins_overlap_masks = torch.ones_like(
+                    gt_masks_per_image, dtype=torch.float32
+                )
             # aggregate the overlap penalties
-            overlap_penalty.append(per_ins_overlap_masks.to(device="cuda"))
+            overlap_penalty.append(per_ins_overlap_masks)
             
-        # aggregate boundary penalties for each image
-        boundary_penalty = torch.cat(boundary_penalty, 0).to(device="cuda")
-        #np.save("boundary.npy", boundary_penalty.detach().cpu().numpy())
-
         # aggregate the roi penalties from each image
-        roi_penalty = torch.cat(roi_penalty, 0).to(device="cuda")
+        roi_penalty = torch.cat(roi_penalty, 0)
         #np.save("roi.npy", roi_penalty.detach().cpu().numpy())
 
         # aggregate the overlap penalties from each image
         # get the real number of overlapping objects
-        overlap_penalty = torch.cat(overlap_penalty, 0).to(device="cuda")
+        # when no image has overlapping gt masks the penalty is all ones, so skip it
+        overlap_penalty = torch.cat(overlap_penalty, 0) if has_overlap else None
         #np.save("overlap.npy", overlap_penalty.detach().cpu().numpy())
         # -------------------------------------------------------------------------------------------- #
 
-        if len(gt_masks) == 0:
-            return pred_mask_logits.sum() * 0
-
         gt_masks = cat(gt_masks, dim=0)
 
         if cls_agnostic_mask:
@@ -245,16 +239,35 @@ class BaseMaskRCNNHead(nn.Module):
         else:
             # Here we allow gt_masks to be float as well (depend on the implementation of rasterize())
             gt_masks_bool = gt_masks > 0.5
-        gt_masks = gt_masks.to(dtype=torch.float32)
+        # cast to the prediction dtype rather than forcing fp32, so that under mixed
+        # precision the (B, M, M) target is not duplicated at double the width
+        gt_masks = gt_masks.to(dtype=pred_mask_logits.dtype)
+
+        # get the boundary pixels for the whole batch in one shot
+        # XOR(dilate, erode) is the morphological gradient; a 3x3 max pool on the
+        # float masks (and on their negation, for erosion) computes it for every
+        # instance of the batch in a single batched kernel
+        masks_f = gt_masks.unsqueeze(1)
+        dilation = F.max_pool2d(masks_f, kernel_size=3, stride=1, padding=1)
+        erosion = -F.max_pool2d(-masks_f, kernel_size=3, stride=1, padding=1)
+        boundary_penalty = (dilation != erosion).squeeze(1).to(dtype=torch.float32)
 
         # Log the training accuracy (using gt classes and 0.5 threshold)
         mask_incorrect = (pred_mask_logits > 0.0) != gt_masks_bool
-        mask_accuracy = 1 - (mask_incorrect.sum().item() / max(mask_incorrect.numel(), 1.0))
-        num_positive = gt_masks_bool.sum().item()
-        false_positive = (mask_incorrect & ~gt_masks_bool).sum().item() / max(
-            gt_masks_bool.numel() - num_positive, 1.0
-        )
-        false_negative = (mask_incorrect & gt_masks_bool).sum().item() / max(num_positive, 1.0)
+        # batch the reductions so the counters leave the device in one copy
+        # instead of one sync per .item()
+        stats = torch.stack(
+            [
+                mask_incorrect.sum(),
+                (mask_incorrect & ~gt_masks_bool).sum(),
+                (mask_incorrect & gt_masks_bool).sum(),
+                gt_masks_bool.sum(),
+            ]
+        ).cpu()
+        num_incorrect, num_fp, num_fn, num_positive = stats.tolist()
+        mask_accuracy = 1 - (num_incorrect / max(mask_incorrect.numel(), 1.0))
+        false_positive = num_fp / max(gt_masks_bool.numel() - num_positive, 1.0)
+        false_negative = num_fn / max(num_positive, 1.0)
 
         storage = get_event_storage()
         storage.put_scalar("mask_rcnn/accuracy", mask_accuracy)
@@ -265,7 +278,8 @@ class BaseMaskRCNNHead(nn.Module):
             vis_masks = torch.cat([pred_masks, gt_masks], axis=2)
             name = "Left: mask prediction;   Right: mask GT"
             for idx, vis_mask in enumerate(vis_masks):
-                vis_mask = torch.stack([vis_mask] * 3, axis=0)
+                # expand is a view; no need to materialize the triplicated channels
+                vis_mask = vis_mask.unsqueeze(0).expand(3, -1, -1)
                 storage.put_image(name + f" ({idx})", vis_mask)
 
         # -------------------------------------------------------------------------------------------- #
@@ -273,26 +287,25 @@ class BaseMaskRCNNHead(nn.Module):
         # pred_mask_logits will then be left to only include the mask for the predicted instance
 
         # apply penalties to the losses
-        boundary_mask_loss = F.binary_cross_entropy_with_logits(pred_mask_logits, 
-                                gt_masks, weight=boundary_penalty, reduction="none")
-
-        roi_mask_loss = F.binary_cross_entropy_with_logits(pred_mask_logits, 
-                                gt_masks, weight=roi_penalty, reduction="none")
-
-        overlap_mask_loss = F.binary_cross_entropy_with_logits(pred_mask_logits, 
-                                gt_masks, weight=overlap_penalty, reduction="none")
+        # the weight argument only scales the elementwise BCE, so compute the base
+        # term once; the penalties and the learned precisions then collapse into a
+        # single combined weight
+        base_mask_loss = F.binary_cross_entropy_with_logits(
+            pred_mask_logits, gt_masks, reduction="none"
+        )
 
         # calcualte relative weighing of the losses
-        precision1 = torch.exp(-self.log_vars[0])
-        weighted_mask_loss = precision1 * boundary_mask_loss + self.log_vars[0]
-
-        precision2 = torch.exp(-self.log_vars[1])
-        weighted_mask_loss += precision2 * roi_mask_loss + self.log_vars[1]
+        precisions = torch.exp(-self.log_vars)
+        total_weight = precisions[0] * boundary_penalty + precisions[1] * roi_penalty
+        if overlap_penalty is not None:
+            total_weight = total_weight + precisions[2] * overlap_penalty
+        else:
+            # an all-ones overlap penalty (no image with overlapping gt masks)
+            # contributes its precision as a plain scalar
+            total_weight = total_weight + precisions[2]
 
-        precision3 = torch.exp(-self.log_vars[2])
-        weighted_mask_loss += precision3 * overlap_mask_loss + self.log_vars[2]
-        
-        return torch.mean(weighted_mask_loss)
+        # the log_vars enter as scalar offsets, so they can be added after the mean
+        return torch.mean(base_mask_loss * total_weight) + self.log_vars.sum()
 
     def forward(self, x: Dict[str, torch.Tensor], instances: List[Instances]):
         """
@@ -393,39 +406,37 @@ def build_mask_head(cfg, input_shape):
     name = cfg.MODEL.ROI_MASK_HEAD.NAME
     return ROI_MASK_HEAD_REGISTRY.get(name)(cfg, input_shape)
 
-def bb_intersection_over_union(boxA, boxB):
-    # determine the (x, y)-coordinates of the intersection rectangle
-    xA = max(boxA[0], boxB[0])
-    yA = max(boxA[1], boxB[1])
-    xB = min(boxA[2], boxB[2])
-    yB = min(boxA[3], boxB[3])
-
-    # compute the area of intersection rectangle
-    interArea = abs(max((xB - xA, 0)) * max((yB - yA), 0))
-    if interArea == 0:
-        return 0
-    # compute the area of both the prediction and ground-truth
-    # rectangles
-    boxAArea = abs((boxA[2] - boxA[0]) * (boxA[3] - boxA[1]))
-    boxBArea = abs((boxB[2] - boxB[0]) * (boxB[3] - boxB[1]))
-
-    # compute the intersection over union by taking the intersection
-    # area and dividing it by the sum of prediction + ground-truth
-    # areas - the interesection area
-    iou = interArea / float(boxAArea + boxBArea - interArea)
-
-    # return the intersection over union value
-    return iou
-
-def get_all_file_paths(directory): 
-  
-    # initializing empty file paths list 
-    file_paths = [] 
-  
-    # crawling through directory and subdirectories 
-    for root, directories, files in os.walk(directory): 
+# cache for get_all_file_paths, invalidated when the directory mtime changes
+_file_paths_cache = {'mtime': None, 'paths': []}
+
+def get_all_file_paths(directory):
+
+    # reuse the cached crawl if the directory has not changed since
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        mtime = None
+    if mtime is not None and mtime == _file_paths_cache['mtime']:
+        return _file_paths_cache['paths']
+
+    # initializing empty file paths list
+    file_paths = []
+
+    # crawling through directory and subdirectories
+    for root, directories, files in os.walk(directory):
         for filename in files:
-            filepath = os.path.join(root, filename) 
-            file_paths.append(filepath) 
-    # returning all file paths 
+            filepath = os.path.join(root, filename)
+            file_paths.append(filepath)
+
+    _file_paths_cache['mtime'] = mtime
+    _file_paths_cache['paths'] = file_paths
+    # returning all file paths
     return file_paths
+
+def _archive_and_copy(file_paths, filename):
+    # zip the collected files and copy the archive out; runs on a background
+    # thread so the training step never waits on it
+    with ZipFile('{}.zip'.format(filename), 'w') as zip:
+        for file in file_paths:
+            zip.write(file)
+    copyfile('./{}.zip'.format(filename), './drive/My Drive/{}.zip'.format(filename))
@@ -382,7 +382,12 @@ class PolygonMasks:
         """
         if len(results) == 0:
             return torch.empty(0, mask_size, mask_size, dtype=torch.bool, device=device)
-        return torch.stack(results, dim=0).to(device=device)
+        masks = torch.stack(results, dim=0)
+        if device.type == "cuda":
+            # Stage through pinned memory so the copy is asynchronous and can overlap
+            # with work already queued on the stream (e.g. the model forward pass).
+            masks = masks.pin_memory()
+        return masks.to(device=device, non_blocking=True)
 
     def area(self):
         """